@@ -30,10 +30,12 @@ from core.util.modules import get_home_dir
 from interface.pulser_interface import PulserInterface, PulserConstraints
 from collections import OrderedDict
 
+import functools
 import grpc
+import operator
 import os
+import pathlib
 import hardware.swabian_instruments.pulse_streamer_pb2 as pulse_streamer_pb2
-import dill
 import numpy as np #EB 20.09.18 Added for write_waveform method
 
 class PulseStreamer(Base, PulserInterface):
@@ -47,11 +49,22 @@ class PulseStreamer(Base, PulserInterface):
     _uw_x_channel = ConfigOption('uw_x_channel', 3, missing='warn')
 
     _current_waveform_name = '' #class variable in which I store the waveform name (modified by E.B)
-    _current_waveform = [] #class variable in which I store the waveform (modified by E.B)
+    # the waveform is stored as a tuple of numpy arrays (ticks per pulse, channel bitmask per pulse)
+    _empty_waveform = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint8))
+    _current_waveform = _empty_waveform #class variable in which I store the waveform (modified by E.B)
+
+    # all 8 digital channels are always active and have fixed logic levels
+    _num_digital_channels = 8
+    _all_channels_active = {'d_ch{0}'.format(chnl): True for chnl in range(1, _num_digital_channels + 1)}
+    _all_low_levels = dict.fromkeys(range(_num_digital_channels), 0.0)
+    _all_high_levels = dict.fromkeys(range(_num_digital_channels), 3.3)
+    # bitmask value of each single digital channel, fits into one byte for the 8 channels
+    _channel_bits = np.array([1 << chnl for chnl in range(_num_digital_channels)], dtype=np.uint8)
 
     def __init__(self, config, **kwargs):
         super().__init__(config=config, **kwargs)
         self._currently_loaded_waveform = ''  # loaded and armed waveform name
+        self._sequence_cache_key = None  # waveform name the serialized sequence was built for
 
         if 'pulsed_file_dir' in config.keys():
             self.pulsed_file_dir = config['pulsed_file_dir']
@@ -71,21 +84,57 @@ class PulseStreamer(Base, PulserInterface):
                              'PulseStreamer as directory for the pulsed files!\nThe default home '
                              'directory\n{0}\nwill be taken instead.'.format(self.pulsed_file_dir))
 
+        self._pulsed_root = pathlib.Path(os.path.abspath(self.pulsed_file_dir))
+
         self.host_waveform_directory = self._get_dir_for_name('sampled_hardware_files')
 
         self.current_status = -1
         self.sample_rate = 1e9
         self.current_loaded_asset = None
 
-        self._channel = grpc.insecure_channel(self._pulsestreamer_ip + ':50051')
+        # Large sequences easily exceed the default 4 MB message limit. The device is always on the
+        # local network, so there is no need to probe for an HTTP proxy.
+        channel_options = [('grpc.enable_http_proxy', 0),
+                           ('grpc.max_send_message_length', 256 << 20),
+                           ('grpc.max_receive_message_length', 256 << 20)]
+        self._channel = grpc.insecure_channel(self._pulsestreamer_ip + ':50051',
+                                              options=channel_options)
 
     def on_activate(self):
         """ Establish connection to pulse streamer and tell it to cancel all operations """
         self.pulse_streamer = pulse_streamer_pb2.PulseStreamerStub(self._channel)
+        # same RPCs as self.pulse_streamer.stream/constant, but taking already serialized messages.
+        # The method paths come from the generated descriptor, so they follow a regenerated pb2.
+        service = pulse_streamer_pb2.DESCRIPTOR.services_by_name['PulseStreamer']
+        self._stream_serialized = self._channel.unary_unary('/{0}/{1}'.format(service.full_name, 'stream'))
+        self._constant_serialized = self._channel.unary_unary('/{0}/{1}'.format(service.full_name, 'constant'))
+
+        # The channel masks only depend on the config, so the constant pulses are built and
+        # serialized only once.
+        self._laser_mask = self._to_bitmask((self._laser_channel,))
+        self._laser_uw_mask = self._to_bitmask((self._laser_channel, self._uw_x_channel))
+        self._constant_pulses = {
+            'blank': pulse_streamer_pb2.PulseMessage(ticks=0, digi=0, ao0=0, ao1=0),
+            'laser_on': pulse_streamer_pb2.PulseMessage(ticks=0, digi=self._laser_mask, ao0=0, ao1=0),
+            'laser_and_uw_on': pulse_streamer_pb2.PulseMessage(ticks=0, digi=self._laser_uw_mask, ao0=0,
+                                                               ao1=0)}
+        self._serialized_constant_pulses = {name: pulse.SerializeToString()
+                                            for name, pulse in self._constant_pulses.items()}
+
+        # The connection is only established lazily on the first RPC. Wait for it here, so
+        # that the first pulse upload does not pay for the TCP and HTTP/2 handshake.
+        try:
+            grpc.channel_ready_future(self._channel).result(timeout=5)
+        except grpc.FutureTimeoutError:
+            self.current_status = -1
+            self.log.error('Could not connect to PulseStreamer at {0}.'.format(self._pulsestreamer_ip))
+            raise
         self.pulser_off()
         self.current_status = 0
 
     def on_deactivate(self):
+        del self._constant_serialized
+        del self._stream_serialized
         del self.pulse_streamer
 
     def get_constraints(self):
@@ -161,7 +210,7 @@ class PulseStreamer(Base, PulserInterface):
         @return int: error code (0:OK, -1:error)
         """
         # start the pulse sequence
-        self.pulse_streamer.stream(self._sequence)
+        self._stream_serialized(self._sequence_bytes)
         self.log.info('Asset uploaded to PulseStreamer')
         self.pulse_streamer.startNow(pulse_streamer_pb2.VoidMessage())
         self.current_status = 1
@@ -173,8 +222,7 @@ class PulseStreamer(Base, PulserInterface):
         @return int: error code (0:OK, -1:error)
         """
         # stop the pulse sequence
-        channels = self._convert_to_bitmask([self._laser_channel, self._uw_x_channel])
-        self.pulse_streamer.constant(pulse_streamer_pb2.PulseMessage(ticks=0, digi=channels, ao0=0, ao1=0))
+        self._set_constant('laser_and_uw_on')
         self.current_status = 0
         return 0
 
@@ -229,18 +277,27 @@ class PulseStreamer(Base, PulserInterface):
                            'Only one waveform at a time can be held.'.format(waveform))
             return self.get_loaded_assets()
 
-        pulse_sequence = []
-        for pulse in self._current_waveform:
-            pulse_sequence.append(pulse_streamer_pb2.PulseMessage(ticks=pulse[0], digi=pulse[1], ao0=0, ao1=1))
+        # re-arming the same waveform reuses the already built and serialized sequence
+        if waveform == self._sequence_cache_key:
+            self._currently_loaded_waveform = waveform
+            return self.get_loaded_assets()
 
-        blank_pulse = pulse_streamer_pb2.PulseMessage(ticks=0, digi=0, ao0=0, ao1=0)
-        laser_on = pulse_streamer_pb2.PulseMessage(ticks=0, digi=self._convert_to_bitmask([self._laser_channel]), ao0=0,
-                                                   ao1=0)
-        laser_and_uw_channels = self._convert_to_bitmask([self._laser_channel, self._uw_x_channel])
-        laser_and_uw_on = pulse_streamer_pb2.PulseMessage(ticks=0, digi=laser_and_uw_channels, ao0=0, ao1=0)
-        self. \
-            _sequence = pulse_streamer_pb2.SequenceMessage(pulse=pulse_sequence, n_runs=0, initial=laser_on,
-                                                           final=laser_and_uw_on, underflow=blank_pulse, start=1)
+        sequence = pulse_streamer_pb2.SequenceMessage(n_runs=0,
+                                                      initial=self._constant_pulses['laser_on'],
+                                                      final=self._constant_pulses['laser_and_uw_on'],
+                                                      underflow=self._constant_pulses['blank'],
+                                                      start=1)
+
+        # The PulseStreamer only accepts the whole sequence in a single stream() call with one
+        # PulseMessage per pulse. The pulses are created directly inside the repeated field, which
+        # avoids building a separate PulseMessage per pulse that extend() would copy again. The
+        # numpy arrays are converted to python ints in one go.
+        add_pulse = sequence.pulse.add
+        ticks, digi = self._current_waveform
+        for t, d in zip(ticks.tolist(), digi.tolist()):
+            add_pulse(ticks=t, digi=d, ao0=0, ao1=1)
+        self._sequence_bytes = sequence.SerializeToString()
+        self._sequence_cache_key = waveform
 
         self._currently_loaded_waveform = waveform
         return self.get_loaded_assets()
@@ -292,9 +349,9 @@ class PulseStreamer(Base, PulserInterface):
         (PulseBlaster, FPGA).
         """
         self._currently_loaded_waveform = ''
+        self._sequence_cache_key = None
         self._current_waveform_name = ''
-        self._current_waveform = []
-        print(self._current_waveform)  # Added by EB for debugging
+        self._current_waveform = self._empty_waveform
 
         return 0
 
@@ -406,21 +463,10 @@ class PulseStreamer(Base, PulserInterface):
         In general there is no bijective correspondence between
         (amplitude, offset) and (value high, value low)!
         """
-        if low is None:
-            low = []
-        if high is None:
-            high = []
-        low_dict = {}
-        high_dict = {}
-        if low is [] and high is []:
-            for channel in range(8):
-                low_dict[channel] = 0.0
-                high_dict[channel] = 3.3
-        else:
-            for channel in low:
-                low_dict[channel] = 0.0
-            for channel in high:
-                high_dict[channel] = 3.3
+        if not low and not high:
+            return self._all_low_levels.copy(), self._all_high_levels.copy()
+        low_dict = dict.fromkeys(low or [], 0.0)
+        high_dict = dict.fromkeys(high or [], 3.3)
         return low_dict, high_dict
 
     def set_digital_level(self, low=None, high=None):
@@ -473,16 +519,9 @@ class PulseStreamer(Base, PulserInterface):
 
               If no parameter (or None) is passed to this method all channel states will be returned.
         """
-        if ch is None:
-            ch = {}
-        d_ch_dict = {}
-        if len(ch) < 1:
-            for chnl in range(1, 9):
-                d_ch_dict['d_ch{0}'.format(chnl)] = True
-        else:
-            for channel in ch:
-                d_ch_dict[channel] = True
-        return d_ch_dict
+        if not ch:
+            return self._all_channels_active.copy()
+        return dict.fromkeys(ch, True)
 
     def set_active_channels(self, ch=None):
         """
@@ -512,18 +551,7 @@ class PulseStreamer(Base, PulserInterface):
                to activate analog channel 2 digital channel 3 and 4 and to deactivate
                digital channel 1. All other available channels will remain unchanged.
                """
-        if ch is None:
-            ch = {}
-        d_ch_dict = {
-            'd_ch1': True,
-            'd_ch2': True,
-            'd_ch3': True,
-            'd_ch4': True,
-            'd_ch5': True,
-            'd_ch6': True,
-            'd_ch7': True,
-            'd_ch8': True}
-        return d_ch_dict
+        return self._all_channels_active.copy()
 
     def write_waveform(self, name, analog_samples, digital_samples, is_first_chunk, is_last_chunk,
                        total_number_of_samples): ## Modified by E.B
@@ -556,41 +584,54 @@ class PulseStreamer(Base, PulserInterface):
         """
 
 
+        # every write replaces the stored waveform, so the serialized sequence is outdated
+        self._sequence_cache_key = None
+
         # Initialize waveform array if this is the first chunk to write
         if is_first_chunk:
             self._current_waveform_name = name
-            self._current_waveform=[]
-
-        # Building the matrix of digital_samples_mat from the dictionary of digital_samples
-        total_number_of_samples = len(digital_samples['d_ch1'])
-        digital_samples_mat = np.zeros((8, total_number_of_samples))
-        digital_samples_mat = np.array(
-            [digital_samples['d_ch1'], digital_samples['d_ch2'], digital_samples['d_ch3'],
-             digital_samples['d_ch4'], digital_samples['d_ch5'], digital_samples['d_ch6'],
-             digital_samples['d_ch7'], digital_samples['d_ch8']])
-
-        channel_number = digital_samples_mat.shape[0]
-        digital_samples_mat = np.transpose(digital_samples_mat)
-
-        # fetch locations where digital channel states change, and eliminate duplicates
-        new_channel_indices = np.where(digital_samples_mat[:-1, :] != digital_samples_mat[1:, :])[0]
-        new_channel_indices = np.unique(new_channel_indices)
-
-        # add in indices for the start and end of the sequence to simplify iteration
-        new_channel_indices = np.insert(new_channel_indices, 0, [-1])
-        new_channel_indices = np.insert(new_channel_indices, new_channel_indices.size,
-                                        [digital_samples_mat.shape[0] - 1])
-
-        pulses = []
-        for new_channel_index in range(1, new_channel_indices.size):
-            pulse = [new_channel_indices[new_channel_index] - new_channel_indices[new_channel_index - 1],
-                     self._convert_to_bitmask_bool(
-                         digital_samples_mat[new_channel_indices[new_channel_index - 1] + 1, :])]
-            pulses.append(pulse)
-
-        #Write the waveform
-        self._current_waveform=pulses
-        print(self._current_waveform)# Added by EB for debugging
+            self._current_waveform = self._empty_waveform
+
+        # Pack the 8 digital channels into a single uint8 array (bit k is channel d_ch<k+1>), so
+        # that every sample already holds the bitmask expected by the PulseStreamer. Each channel
+        # is viewed as uint8 (no copy for bool input), multiplied by its bit from _channel_bits
+        # into one reused scratch buffer and ORed into the packed array.
+        channel_samples = [digital_samples['d_ch{0}'.format(chnl)]
+                           for chnl in range(1, self._num_digital_channels + 1)]
+        total_number_of_samples = len(channel_samples[0])
+        non_bool_channels = ['d_ch{0}'.format(chnl)
+                             for chnl, samples in enumerate(channel_samples, 1)
+                             if samples.dtype != np.bool_]
+        if non_bool_channels:
+            self.log.warning('Digital samples of channels {0} are not of type bool and need to be '
+                             'converted.'.format(', '.join(non_bool_channels)))
+        packed = np.zeros(total_number_of_samples, dtype=np.uint8)
+        shifted = np.empty(total_number_of_samples, dtype=np.uint8)
+        for samples, channel_bit in zip(channel_samples, self._channel_bits):
+            samples = np.asarray(samples, dtype=bool).view(np.uint8)
+            np.multiply(samples, channel_bit, out=shifted)
+            np.bitwise_or(packed, shifted, out=packed)
+
+        # fetch locations where the digital channel states change (last sample of each pulse). The
+        # XOR of neighbouring samples is non-zero wherever any channel toggles; scanning a 1D array
+        # yields every edge once and in order, so no np.unique is needed.
+        edges = np.flatnonzero(packed[1:] ^ packed[:-1])
+
+        # first sample of every pulse plus the end of the sequence, filled in a single allocation
+        boundaries = np.empty(edges.size + 2, dtype=np.int64)
+        boundaries[0] = 0
+        np.add(edges, 1, out=boundaries[1:-1])
+        boundaries[-1] = total_number_of_samples
+
+        ticks = np.diff(boundaries)
+        # the bitmask of each pulse is simply the packed value of its first sample, so no
+        # per-pulse call to _to_bitmask is needed
+        digi = packed[boundaries[:-1]]
+
+        #Write the waveform as (ticks, digi) arrays
+        self._current_waveform = (ticks, digi)
+        self.log.debug('Waveform "{0}" written to PulseStreamer with {1} pulses.'
+                       ''.format(self._current_waveform_name, ticks.size))
 
         return total_number_of_samples, [self._current_waveform_name]
 
@@ -619,29 +660,36 @@ class PulseStreamer(Base, PulserInterface):
 
         @return list: List of all uploaded sequence name strings in the device workspace.
         """
-        return list()
+        return []
 
-    def delete_waveform(self, waveform_name):
+    @staticmethod
+    def delete_waveform(waveform_name):
         """ Delete the waveform with name "waveform_name" from the device memory.
 
         @param str waveform_name: The name of the waveform to be deleted
                                   Optionally a list of waveform names can be passed.
 
         @return list: a list of deleted waveform names.
+
+        Nothing is stored on the device, so nothing is deleted.
         """
-        return
+        return []
 
-    def delete_sequence(self, sequence_name):
+    @staticmethod
+    def delete_sequence(sequence_name):
         """ Delete the sequence with name "sequence_name" from the device memory.
 
         @param str sequence_name: The name of the sequence to be deleted
                                   Optionally a list of sequence names can be passed.
 
         @return list: a list of deleted sequence names.
+
+        Nothing is stored on the device, so nothing is deleted.
         """
-        return list()
+        return []
 
-    def get_interleave(self):
+    @staticmethod
+    def get_interleave():
         """ Check whether Interleave is ON or OFF in AWG.
 
         @return bool: True: ON, False: OFF
@@ -650,7 +698,8 @@ class PulseStreamer(Base, PulserInterface):
         """
         return False
 
-    def set_interleave(self, state=False):
+    @staticmethod
+    def set_interleave(state=False):
         """ Turns the interleave of an AWG on or off.
 
         @param bool state: The state the interleave should be set to
@@ -670,59 +719,33 @@ class PulseStreamer(Base, PulserInterface):
 
         @return int: error code (0:OK, -1:error)
         """
-        channels = self._convert_to_bitmask([self._laser_channel, self._uw_x_channel])
-        self.pulse_streamer.constant(pulse_streamer_pb2.PulseMessage(ticks=0, digi=channels, ao0=0, ao1=0))
-        self.pulse_streamer.constant(laser_on)
+        self._set_constant('laser_on')
         return 0
 
-    def has_sequence_mode(self):
+    @staticmethod
+    def has_sequence_mode():
         """ Asks the pulse generator whether sequence mode exists.
 
         @return: bool, True for yes, False for no.
         """
         return False
 
-    def _convert_to_bitmask_bool(self, active_channels): ## Modified by E.B
-        """ Convert a boolean np_array of active channels into a bitmask.
-        @param numpy.array active_channels: the list of active channels like
-                            e.g. [0,4,7]. Note that the channels start from 0.
-        @return int: The channel-list is converted into a bitmask (an sequence
-                     of 1 and 0). The returned integer corresponds to such a
-                     bitmask.
-        Note that you can get a binary representation of an integer in python
-        if you use the command bin(<integer-value>). All higher unneeded digits
-        will be dropped, i.e. 0b00100 is turned into 0b100. Examples are
-            bin(0) =    0b0
-            bin(1) =    0b1
-            bin(8) = 0b1000
-        Each bit value (read from right to left) corresponds to the fact that a
-        channel is on or off. I.e. if you have
-            0b001011
-        then it would mean that only channel 0, 1 and 3 are switched to on, the
-        others are off.
-        Helper method for write_pulse_form.
-        """
-        bits = 0  # that corresponds to: 0b0
-        active_channels = np.where(active_channels == True)
-        for channel in active_channels[0]:
-            # go through each list element and create the digital word out of
-            # 0 and 1 that represents the channel configuration. In order to do
-            # that a bitwise shift to the left (<< operator) is performed and
-            # the current channel configuration is compared with a bitwise OR
-            # to check whether the bit was already set. E.g.:
-            #   0b1001 | 0b0110: compare elementwise:
-            #           1 | 0 => 1
-            #           0 | 1 => 1
-            #           0 | 1 => 1
-            #           1 | 1 => 1
-            #                   => 0b1111
-            bits = bits | (1 << channel)
-        return bits
-
-    def  _convert_to_bitmask(self, active_channels): ## Modified by E.B
-        """ Convert a list of channels into a bitmask.
-        @param numpy.array active_channels: the list of active channels like
-                            e.g. [0,4,7]. Note that the channels start from 0.
+    def _set_constant(self, pulse_name):
+        """ Set the outputs of the device to a constant state.
+
+        @param str pulse_name: name of the constant output state in self._constant_pulses
+
+        All constant() RPCs go through this method and send the pre-serialized message.
+        """
+        self._constant_serialized(self._serialized_constant_pulses[pulse_name])
+
+    def _to_bitmask(self, active_channels): ## Modified by E.B
+        """ Convert a list of channels or a boolean np_array of active channels into a bitmask.
+        @param list|numpy.array active_channels: either the list of active
+                            channels like e.g. [0,4,7] or a boolean array with
+                            one entry per channel, e.g. [True, False, False, True]
+                            for the channels 0 and 3. Note that the channels
+                            start from 0.
         @return int: The channel-list is converted into a bitmask (an sequence
                      of 1 and 0). The returned integer corresponds to such a
                      bitmask.
@@ -737,23 +760,32 @@ class PulseStreamer(Base, PulserInterface):
             0b001011
         then it would mean that only channel 0, 1 and 3 are switched to on, the
         others are off.
-        Helper method for write_pulse_form.
-        """
-        bits = 0     # that corresponds to: 0b0
-        for channel in active_channels:
-            # go through each list element and create the digital word out of
-            # 0 and 1 that represents the channel configuration. In order to do
-            # that a bitwise shift to the left (<< operator) is performed and
-            # the current channel configuration is compared with a bitwise OR
-            # to check whether the bit was already set. E.g.:
-            #   0b1001 | 0b0110: compare elementwise:
-            #           1 | 0 => 1
-            #           0 | 1 => 1
-            #           0 | 1 => 1
-            #           1 | 1 => 1
-            #                   => 0b1111
-            bits = bits | (1<< channel)
-        return bits
+        Used once on activation to build the constant laser and microwave
+        pulses. The per-pulse bitmasks of a waveform are read directly from the
+        packed samples in write_waveform and never go through this helper.
+        """
+        active_channels = np.asarray(active_channels)
+        if active_channels.dtype == np.bool_:
+            # packbits with little bit order puts channel 0 into the lowest bit of the first byte.
+            # The bytes are again little endian, which also covers more than 8 channels.
+            packed = np.packbits(active_channels, bitorder='little')
+            return int.from_bytes(packed.tobytes(), 'little')
+
+        # Create the digital word out of 0 and 1 that represents the channel
+        # configuration. For each channel a bitwise shift to the left (<< operator)
+        # is performed and the words are combined with a bitwise OR, which keeps a
+        # bit that was already set (e.g. if laser and microwave share a channel). E.g.:
+        #   0b1001 | 0b0110: compare elementwise:
+        #           1 | 0 => 1
+        #           0 | 1 => 1
+        #           0 | 1 => 1
+        #           1 | 1 => 1
+        #                   => 0b1111
+        channels = active_channels.astype(np.intp, copy=False).tolist()
+        return functools.reduce(operator.or_, (1 << channel for channel in channels), 0)
+
+    # former names of the channel list and boolean array variants
+    _convert_to_bitmask = _convert_to_bitmask_bool = _to_bitmask
 
 
 
@@ -768,7 +800,8 @@ class PulseStreamer(Base, PulserInterface):
         self.log.debug('PulseStreamer has no own storage capability.\n"upload_asset" call ignored.')
         return 0
 
-    def tell(self, command):
+    @staticmethod
+    def tell(command):
         """ Sends a command string to the device.
 
         @param string command: string containing the command
@@ -777,7 +810,8 @@ class PulseStreamer(Base, PulserInterface):
         """
         return 0
 
-    def ask(self, question):
+    @staticmethod
+    def ask(question):
         """ Asks the device a 'question' and receive and return an answer from it.
         @param string question: string containing the command
 
@@ -791,10 +825,9 @@ class PulseStreamer(Base, PulserInterface):
         @param name: string, name of the folder
         @return: string, absolute path to the directory with folder 'name'.
         """
-        path = os.path.join(self.pulsed_file_dir, name)
-        if not os.path.exists(path):
-            os.makedirs(os.path.abspath(path))
-        return os.path.abspath(path)
+        path = self._pulsed_root / name
+        path.mkdir(parents=True, exist_ok=True)
+        return str(path)
 
 
 